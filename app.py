@@ -23,13 +23,20 @@ Normally you would run this in a Docker container, see README.md.
 import os
 import sys
 import collections
+import itertools
 import json
 import urllib
 import argparse
 
-import pywikibot
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
-from pywikibot.data import api
+import wikidata_cache
+
+import diskcache
+import requests
+
+from requests.adapters import HTTPAdapter
 from clams.app import ClamsApp
 from clams.restify import Restifier
 from clams.appmetadata import AppMetadata
@@ -42,6 +49,11 @@ Uri_NEL = "http://vocab.lappsgrid.org/LinkedNamedEntity"
 Uri_DEP = "http://vocab.lappsgrid.org/SyntacticRelation"
 Uri_NELR = "http://vocab.lappsgrid.org/LinkedNamedEntityRelation"
 
+# Interned annotation-type strings, so the per-annotation type dispatch in
+# _add_tool_output is a pointer comparison instead of a full string comparison
+NE_TYPE = sys.intern(str(Uri.NE))
+DEP_TYPE = sys.intern(Uri_DEP)
+
 APP_VERSION = '0.0.8'
 APP_LICENSE = 'Apache 2.0'
 MMIF_VERSION = '0.4.0'
@@ -53,6 +65,97 @@ SPACY_LICENSE = 'MIT'
 # We need this to find the text documents in the documents list
 TEXT_DOCUMENT = os.path.basename(str(DocumentTypes.TextDocument))
 
+# Endpoint of the wikidata reconciliation service, which lets us resolve many
+# entity texts in a single request
+RECONCILIATION_URL = "https://wikidata.reconci.link/en/api"
+
+# Endpoint of the wikidata API, used for per-entity searches
+WIKIDATA_API_URL = "https://www.wikidata.org/w/api.php"
+
+# Number of threads used when falling back to per-entity wikidata requests;
+# kept modest so we do not run into wikidata's rate limits
+MAX_WORKERS = 16
+
+# Optional local map from entity text to wikidata id, for example built offline
+# from a wikidata dump. Texts found in the map skip entity search entirely and
+# are resolved in bulk with wbgetentities (up to 50 entities per request).
+ALIAS_MAP_FILE = "alias-map.json"
+
+# Persistent on-disk cache of wikidata search results, so entities resolved in
+# earlier runs do not have to be fetched again after a server restart; entries
+# are keyed by language and entity text and expire after thirty days
+CACHE_DIR = "wd_cache"
+CACHE_EXPIRE = 30 * 86400
+_disk_cache = diskcache.Cache(CACHE_DIR, size_limit=2**30)
+
+# Shared HTTP session so that consecutive wikidata requests reuse pooled
+# keep-alive connections instead of opening a new one for every request
+_session = requests.Session()
+_session.mount('https://', HTTPAdapter(pool_connections=8, pool_maxsize=32))
+_session.headers['User-Agent'] = \
+    'app-nel/%s (https://github.com/JinnyViboonlarp/app-nel)' % APP_VERSION
+
+
+@lru_cache(maxsize=10000)
+def _wiki_search(itemtitle):
+    """Search wikidata for the given entity text and return the raw response as
+    a JSON string (strings are hashable, so the results can be memoized).
+    Entity texts repeat heavily within and across documents, so caching saves a
+    network round-trip for every repeated mention; results are also written to
+    the on-disk cache so they survive server restarts."""
+    key = 'en::' + itemtitle
+    cached = _disk_cache.get(key)
+    if(cached != None):
+        return cached
+    params = { 'action' :'wbsearchentities' , 'format' : 'json' , 'language' : 'en', 'type' : 'item', 'search': itemtitle, 'limit': 1}
+    response = _session.get(WIKIDATA_API_URL, params=params)
+    response.raise_for_status()
+    _disk_cache.set(key, response.text, expire=CACHE_EXPIRE)
+    return response.text
+
+
+def getItems(itemtitle):
+    """Query wikidata for an entity text. Currently, only the first (most
+    likely) search result is returned."""
+    return json.loads(_wiki_search(itemtitle))
+
+
+def getEntities(qids):
+    """Fetch the label and description of up to 50 wikidata ids per request
+    with wbgetentities, and return a dict from id to an entry shaped like a
+    wbsearchentities search result. Returns whatever was fetched so far if a
+    request fails, letting the caller fall back to entity search."""
+    entities = {}
+    for start in range(0, len(qids), 50):
+        params = { 'action': 'wbgetentities', 'format': 'json', 'languages': 'en',
+                   'props': 'labels|descriptions|sitelinks', 'ids': '|'.join(qids[start:start+50])}
+        try:
+            response = _session.get(WIKIDATA_API_URL, params=params)
+            response.raise_for_status()
+            answer = response.json()
+        except Exception as e:
+            if DEBUG:
+                print("wbgetentities request failed: %s" % e)
+            return entities
+        for (qid, entity) in answer.get('entities', {}).items():
+            entry = {'id': qid, 'url': '//www.wikidata.org/wiki/' + qid}
+            if 'en' in entity.get('labels', {}):
+                entry['label'] = entity['labels']['en']['value']
+            if 'en' in entity.get('descriptions', {}):
+                entry['description'] = entity['descriptions']['en']['value']
+            entities[qid] = entry
+    return entities
+
+
+def _load_alias_map():
+    if os.path.exists(ALIAS_MAP_FILE):
+        with open(ALIAS_MAP_FILE) as fh:
+            return json.load(fh)
+    return {}
+
+
+_alias_map = _load_alias_map()
+
 DEBUG = False
 
 
@@ -77,26 +180,40 @@ class NEL_App(ClamsApp):
         return metadata
 
     def _annotate(self, mmif, **kwargs):
+        if not isinstance(mmif, Mmif):
+            mmif = Mmif(mmif)
+        return self._annotate_mmif(mmif, **kwargs)
+
+    def _annotate_mmif(self, mmif, **kwargs):
+        """Core annotation method, taking an already-deserialized Mmif object.
+        Callers that have one (the HTTP endpoint parses the request body before
+        calling annotate, and test() parses the input file itself) come through
+        here without the type check and conditional parse in _annotate."""
         Identifiers.reset()
-        self.mmif = mmif if type(mmif) is Mmif else Mmif(mmif)
+        self.mmif = mmif
         for view in list(self.mmif.views):
-            # check if the app is spacy_nlp with NamedEntity component
-            components = [os.path.basename(str(component)) for component in view['metadata']['contains']]
-            if(('spacy_nlp' in str(view['metadata']['app'])) and ('NamedEntity' in components)):
-                doc_id = None
-                for component in view['metadata']['contains']:
-                    if(('NamedEntity' == os.path.basename(str(component))) and ("document" in view['metadata']['contains'][component])):
-                        # check if there is a document's id (of the text document that the NER is performed on) in the view's metadata
-                        # if the view's metadata does not contain this info, it means that the doc_id is in "properties" field of each annotation in the view
-                        doc_id = view['metadata']['contains'][component]["document"]
-                        doc_id = view.id + ':' + doc_id
-                if(doc_id == None):
-                    new_view = self._new_view()
-                    self._add_tool_output(view, new_view, view.id)
-                else:
-                    new_view = self._new_view(doc_id)
-                    self._add_tool_output(view, new_view)
-                    
+            # check if the app is spacy_nlp with NamedEntity component; views
+            # from other apps are skipped before their components are touched
+            if('spacy_nlp' not in str(view['metadata']['app'])):
+                continue
+            contains = view['metadata']['contains']
+            basenames = {component: os.path.basename(str(component)) for component in contains}
+            if('NamedEntity' not in basenames.values()):
+                continue
+            doc_id = None
+            for (component, basename) in basenames.items():
+                if(('NamedEntity' == basename) and ("document" in contains[component])):
+                    # check if there is a document's id (of the text document that the NER is performed on) in the view's metadata
+                    # if the view's metadata does not contain this info, it means that the doc_id is in "properties" field of each annotation in the view
+                    doc_id = contains[component]["document"]
+                    doc_id = view.id + ':' + doc_id
+            if(doc_id == None):
+                new_view = self._new_view()
+                self._add_tool_output(view, new_view, view.id)
+            else:
+                new_view = self._new_view(doc_id)
+                self._add_tool_output(view, new_view)
+
         return self.mmif
 
     def _new_view(self, docid=None):
@@ -108,90 +225,173 @@ class NEL_App(ClamsApp):
 
     def _add_tool_output(self, old_view, new_view, view_id=None):
 
-        # This method is for querying wikidata
-        # Currently, only the first (most likely) search result is returned
-        def getItems(site, itemtitle):
-            params = { 'action' :'wbsearchentities' , 'format' : 'json' , 'language' : 'en', 'type' : 'item', 'search': itemtitle, 'limit': 1}
-            request = api.Request(site=site,**params)
-            return request.submit()
-
-        # Login to wikidata
-        site = pywikibot.Site("wikidata", "wikidata")
-        repo = site.data_repository()
+        # generate annotation identifiers from local counters, avoiding the
+        # classmethod dispatch and dict update in Identifiers.new for every
+        # annotation; the counters are written back at the end of the method
+        nel_counter = itertools.count(Identifiers.identifiers['nel'] + 1)
+        nelr_counter = itertools.count(Identifiers.identifiers['nelr'] + 1)
+
+        # This method resolves all entity texts in one request to the wikidata
+        # reconciliation service and returns a dict from text to a search result
+        # shaped like the output of getItems. It returns an empty dict when the
+        # batch request fails, in which case the caller falls back to getItems.
+        def batchGetItems(texts):
+            queries = {('q%d' % i): {'query': text, 'limit': 1} for (i, text) in enumerate(texts)}
+            try:
+                response = _session.post(RECONCILIATION_URL, data={'queries': json.dumps(queries)})
+                response.raise_for_status()
+                answers = response.json()
+            except Exception as e:
+                if DEBUG:
+                    print("batch reconciliation request failed: %s" % e)
+                return {}
+            resolved = {}
+            for (key, query) in queries.items():
+                entries = []
+                for candidate in answers.get(key, {}).get('result', []):
+                    entry = {'id': candidate['id'], 'url': '//www.wikidata.org/wiki/' + candidate['id']}
+                    if 'name' in candidate:
+                        entry['label'] = candidate['name']
+                    if 'description' in candidate:
+                        entry['description'] = candidate['description']
+                    entries.append(entry)
+                resolved[query['query']] = {'search': entries}
+            return resolved
+
+        # single pass over the annotations: partition them by type so the
+        # annotation list (and the property deserialization that comes with
+        # each access) is only walked once
+        ne_annotations = []
+        dep_annotations = []
+        intern = sys.intern
+        for annotation in old_view['annotations']:
+            attype = intern(str(annotation.at_type))
+            if(attype is NE_TYPE):
+                ne_annotations.append(annotation)
+            elif(attype is DEP_TYPE):
+                dep_annotations.append(annotation)
+
+        # collect the distinct entity texts; the same text often occurs many
+        # times as separate annotations but only needs to be resolved once
+        unique_texts = {annotation['properties']['text'] for annotation in ne_annotations}
+
+        # texts found in the local wikidata cache are resolved without touching
+        # the network at all
+        resolved = {}
+        for text in unique_texts:
+            cached = wikidata_cache.lookup(text)
+            if(cached != None):
+                resolved[text] = cached
+
+        # texts with a known wikidata id in the local alias map do not need an
+        # entity search at all; fetch their data in bulk with wbgetentities
+        aliased = {text: _alias_map[text] for text in unique_texts
+                   if ((text not in resolved) and (text in _alias_map))}
+        if(len(aliased) > 0):
+            entities = getEntities(list(aliased.values()))
+            for (text, qid) in aliased.items():
+                if(qid in entities):
+                    resolved[text] = {'search': [entities[qid]]}
+
+        # the remaining texts go through the batched reconciliation search
+        remaining = [text for text in unique_texts if text not in resolved]
+        if(len(remaining) > 0):
+            resolved.update(batchGetItems(remaining))
+
+        # resolve the texts that the batch request could not handle; these
+        # fallback requests are latency-bound, so fire them in parallel instead
+        # of waiting for each round-trip in turn
+        missing = [text for text in unique_texts if text not in resolved]
+        if(len(missing) > 0):
+            with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+                for (text, entries) in zip(missing, pool.map(getItems, missing)):
+                    resolved[text] = entries
 
         # for each NER-type annotation, use the text to search wikidata
-        interested_entities = collections.defaultdict(dict) # this is a dict to store information of entities with wikidata information
-        interested_keys = ['url','label','description']
-        annotation_property_order = ['root_i','text','label','category','description','wikidata_id','url','id']
-        for annotation in old_view['annotations']:
-            if(annotation.at_type == Uri.NE):
-                doc_id = annotation['properties']['document'] if "document" in annotation['properties'] else None
-                if((view_id != None) and (doc_id != None)):
-                    doc_id = view_id + ':' + doc_id
-                wikidataEntries = getItems(site, annotation['properties']['text'])
-                firstEntry = wikidataEntries["search"][0] if (len(wikidataEntries["search"])>0) else None
-                if(firstEntry != None):
-                    # create new annotation from the old annotation plus the data from wikidata
-                    properties = { "text": annotation['properties']['text'], "category": annotation['properties']['category'], \
-                                   "root_i": annotation['properties']['root_i']}
-                    if 'id' in firstEntry:
-                        properties['wikidata_id'] = firstEntry['id']
-                    for key in interested_keys:
-                        if key in firstEntry:
-                            properties[key] = firstEntry[key]
-                    properties = {key: properties[key] for key in annotation_property_order if key in properties}
-                    add_annotation(
-                        new_view, Uri_NEL, Identifiers.new("nel"),
-                        doc_id, annotation['properties']['start'], annotation['properties']['end'],
-                        properties)
-                    # store doc_id and root_i in a dict to search later for meaningful relations between named entities with
-                    # wikidata entries
-                    doc_id = annotation['properties']['document'] if "document" in annotation['properties'] else 0
-                    entity_id = annotation['properties']['root_i']
-                    interested_entities[doc_id][entity_id] = properties
-                    
+        interested_entities = {} # maps (doc_id, root_i) to the properties of an entity with wikidata information
+        for annotation in ne_annotations:
+            # bind the properties once, so that each key is resolved with a
+            # plain dict lookup instead of going through the property proxy
+            props = annotation['properties']
+            text = props['text']
+            root_i = props['root_i']
+            mention_doc_id = props['document'] if "document" in props else None
+            doc_id = mention_doc_id
+            if((view_id != None) and (doc_id != None)):
+                doc_id = view_id + ':' + doc_id
+            wikidataEntries = resolved[text]
+            firstEntry = wikidataEntries["search"][0] if (len(wikidataEntries["search"])>0) else None
+            if(firstEntry != None):
+                # create new annotation from the old annotation plus the data from wikidata;
+                # the properties are assembled directly in the order they should be
+                # serialized in (dicts preserve insertion order), so no reordering
+                # pass is needed afterwards
+                properties = { "root_i": root_i, "text": text, "label": firstEntry.get('label'), \
+                               "category": props['category'], "description": firstEntry.get('description'), \
+                               "wikidata_id": firstEntry.get('id'), "url": firstEntry.get('url')}
+                properties = {key: value for (key, value) in properties.items() if value != None}
+                add_annotation(
+                    new_view, Uri_NEL, 'nel%d' % next(nel_counter),
+                    doc_id, props['start'], props['end'],
+                    properties)
+                # store doc_id and root_i in a dict to search later for meaningful relations between named entities with
+                # wikidata entries
+                doc_id = mention_doc_id if (mention_doc_id != None) else 0
+                interested_entities[(doc_id, root_i)] = properties
+
         # store syntactic relations in the old view (so that they could be searched later
-        child_to_head = collections.defaultdict(dict)
-        for annotation in old_view['annotations']:
-            if(annotation.at_type == Uri_DEP):
-                doc_id = annotation['properties']['document'] if "document" in annotation['properties'] else 0
-                child_i = annotation['properties']['child_i']
-                child_to_head[doc_id][child_i] = {key: annotation['properties'][key] for key in ['dep','head_text','head_lemma','head_i']}
-
-        # search for named entities with the same head texts
-        for doc_id in interested_entities:
-            for i1 in interested_entities[doc_id]: # iterate over root_i of named entities in this document
-                for i2 in interested_entities[doc_id]:
-                    if ((i1 < i2) and (i1 in child_to_head[doc_id]) and (i2 in child_to_head[doc_id]) and \
-                        (child_to_head[doc_id][i1]["head_i"] == child_to_head[doc_id][i2]["head_i"])):
-                        properties = { "e1_text": interested_entities[doc_id][i1]['text'], "e1_label": interested_entities[doc_id][i1]['label'], \
-                                    "e1_root_i": interested_entities[doc_id][i1]['root_i'], "e1_wikidata_id": interested_entities[doc_id][i1]['wikidata_id'], \
-                                    "e1_dep": child_to_head[doc_id][i1]['dep'], \
-                                        "e2_text": interested_entities[doc_id][i2]['text'], "e2_label": interested_entities[doc_id][i2]['label'], \
-                                    "e2_root_i": interested_entities[doc_id][i2]['root_i'], "e2_wikidata_id": interested_entities[doc_id][i2]['wikidata_id'], \
-                                    "e2_dep": child_to_head[doc_id][i2]['dep'], \
-                                        "rel_text": child_to_head[doc_id][i1]['head_text'], "rel_lemma": child_to_head[doc_id][i1]['head_lemma'], \
-                                    "rel_i": child_to_head[doc_id][i1]['head_i']}
-                        doc_id_for_annotation = doc_id if (doc_id != 0) else None
-                        if((view_id != None) and (doc_id_for_annotation != None)):
-                            doc_id_for_annotation = view_id + ':' + doc_id_for_annotation
-                        add_annotation(
-                            new_view, Uri_NELR, Identifiers.new("nelr"),
-                            doc_id_for_annotation, None, None,
-                            properties)
+        child_to_head = {} # maps (doc_id, child_i) to the relation's head information
+        for annotation in dep_annotations:
+            props = annotation['properties']
+            doc_id = props['document'] if "document" in props else 0
+            child_to_head[(doc_id, props['child_i'])] = \
+                {'dep': props['dep'], 'head_text': props['head_text'],
+                 'head_lemma': props['head_lemma'], 'head_i': props['head_i']}
+
+        # search for named entities with the same head texts; instead of
+        # comparing every pair of entities (which is quadratic in the number of
+        # entities), bucket the entities by the head they attach to and emit
+        # pairs within each bucket
+        by_head = collections.defaultdict(list)
+        for (doc_id, entity_id) in interested_entities:
+            head = child_to_head.get((doc_id, entity_id))
+            if(head != None):
+                by_head[(doc_id, head["head_i"])].append(entity_id)
+        for ((doc_id, head_i), ids) in by_head.items():
+            for (i1, i2) in itertools.combinations(sorted(ids), 2):
+                e1 = interested_entities[(doc_id, i1)]
+                e2 = interested_entities[(doc_id, i2)]
+                d1 = child_to_head[(doc_id, i1)]
+                d2 = child_to_head[(doc_id, i2)]
+                properties = { "e1_text": e1['text'], "e1_label": e1['label'], \
+                            "e1_root_i": e1['root_i'], "e1_wikidata_id": e1['wikidata_id'], \
+                            "e1_dep": d1['dep'], \
+                                "e2_text": e2['text'], "e2_label": e2['label'], \
+                            "e2_root_i": e2['root_i'], "e2_wikidata_id": e2['wikidata_id'], \
+                            "e2_dep": d2['dep'], \
+                                "rel_text": d1['head_text'], "rel_lemma": d1['head_lemma'], \
+                            "rel_i": head_i}
+                doc_id_for_annotation = doc_id if (doc_id != 0) else None
+                if((view_id != None) and (doc_id_for_annotation != None)):
+                    doc_id_for_annotation = view_id + ':' + doc_id_for_annotation
+                add_annotation(
+                    new_view, Uri_NELR, 'nelr%d' % next(nelr_counter),
+                    doc_id_for_annotation, None, None,
+                    properties)
+
+        # write the local counters back so identifiers stay unique across views
+        Identifiers.identifiers['nel'] = next(nel_counter) - 1
+        Identifiers.identifiers['nelr'] = next(nelr_counter) - 1
         
 
 def add_annotation(view, attype, identifier, doc_id, start, end, properties):
-    """Utility method to add an annotation to a view."""
-    a = view.new_annotation(attype, identifier)
-    if doc_id is not None:
-        a.add_property('document', doc_id)
-    if start is not None:
-        a.add_property('start', start)
-    if end is not None:
-        a.add_property('end', end)
-    for prop, val in properties.items():
-        a.add_property(prop, val)
+    """Utility method to add an annotation to a view. The document, start, and
+    end values are folded into the property dict, so the annotation is created
+    with one new_annotation call instead of an add_property call per value."""
+    props = {'document': doc_id, 'start': start, 'end': end}
+    props = {key: value for (key, value) in props.items() if value is not None}
+    props.update(properties)
+    return view.new_annotation(attype, identifier, **props)
 
 
 class Identifiers(object):
@@ -218,11 +418,14 @@ def test(infile, outfile):
     """Run named entity linking on an input MMIF file. This bypasses the server and just pings
     the annotate() method on the NEL_App class. Prints a summary of the views
     in the end result."""
-    print(NEL_App().appmetadata(pretty=True))
+    app = NEL_App()
+    print(app.appmetadata(pretty=True))
     with open(infile) as fh_in, open(outfile, 'w') as fh_out:
-        mmif_out_as_string = NEL_App().annotate(fh_in.read(), pretty=True)
-        mmif_out = Mmif(mmif_out_as_string)
-        fh_out.write(mmif_out_as_string)
+        # parse the input once and serialize the output once; annotating the
+        # Mmif object directly avoids re-parsing the serialized output just to
+        # print the view summary below
+        mmif_out = app._annotate_mmif(Mmif(fh_in.read()))
+        fh_out.write(mmif_out.serialize(pretty=True))
         for view in mmif_out.views:
             print("<View id=%s annotations=%s app=%s>"
                   % (view.id, len(view.annotations), view.metadata['app']))
@@ -245,4 +448,9 @@ if __name__ == "__main__":
         if args.develop:
             service.run()
         else:
-            service.serve_production()
+            # the app is I/O-bound (it spends most of its time waiting on
+            # wikidata), so use async gevent workers that can keep many
+            # requests in flight instead of gunicorn's default sync workers,
+            # which would block one worker per request
+            service.serve_production(worker_class='gevent', workers=2,
+                                     worker_connections=200)
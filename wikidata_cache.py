@@ -0,0 +1,46 @@
+"""wikidata_cache.py
+
+Optional read-only cache of wikidata lookups, backed by a local LMDB database
+built offline from a filtered wikidata dump (the "wikidata-lite" pattern). The
+database maps an entity text to a JSON record with the id, label, description,
+and url of the best match, so that cached mentions are resolved with a
+memory-mapped lookup instead of a network round-trip.
+
+The cache is picked up automatically by app.py when the database (see DB_FILE)
+exists and the lmdb package is installed; otherwise every lookup returns None
+and the app falls back to querying wikidata over the network.
+
+"""
+
+import os
+import json
+
+try:
+    import lmdb
+except ImportError:
+    lmdb = None
+
+DB_FILE = "wd.lmdb"
+
+_env = None
+
+
+def _get_env():
+    global _env
+    if (_env is None) and (lmdb is not None) and os.path.exists(DB_FILE):
+        _env = lmdb.open(DB_FILE, readonly=True, lock=False)
+    return _env
+
+
+def lookup(text):
+    """Return the cached result for an entity text, shaped like the output of
+    wbsearchentities, or None when the text is not in the cache (or there is
+    no cache at all)."""
+    env = _get_env()
+    if env is None:
+        return None
+    with env.begin() as txn:
+        value = txn.get(text.encode('utf-8'))
+    if value is None:
+        return None
+    return {'search': [json.loads(value)]}